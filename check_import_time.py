@@ -0,0 +1,121 @@
+# coding: utf-8
+"""Check the time needed to import the problem, the scripts and submissions.
+
+Each module is imported several times in a fresh Python interpreter. Since
+ramp-workflow creates the feature extractor and the classifier right after
+importing a submission, their creation is timed with the import. The fastest
+run is compared to a budget in seconds and the modules which should only be
+imported on first use are checked not to be loaded by the import alone. The
+script exits with an error if any module is over budget.
+"""
+from __future__ import print_function
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+
+# the functional feature extractors import nilearn.connectome
+FUNCTIONAL_FEATURE_EXTRACTORS = [
+    'submissions/{}/feature_extractor.py'.format(submission)
+    for submission in ('combine_anatomy_functional',
+                       'harmonized_anatomy_functional',
+                       'out_of_core_multi_atlas', 'reduced_functional',
+                       'starting_kit_functional')]
+
+# budget in seconds of the import of each file and of the creation of its
+# estimators, the submissions not listed using the default budget; the
+# budgets are about twice the times measured on a workstation: 0.55s for the
+# problem, 0.02s for download_data.py, 0.5s for the submissions importing
+# sklearn and pandas and 0.95s for those also importing nilearn.connectome
+BUDGET = dict({
+    'problem.py': 1.,
+    'download_data.py': 0.1,
+}, **{filename: 1.5 for filename in FUNCTIONAL_FEATURE_EXTRACTORS})
+DEFAULT_BUDGET = 1.
+
+# heavy modules which should not be imported by importing a file
+LAZY_MODULES = dict({
+    # ramp-workflow, needed to define the problem, imports most of sklearn
+    'problem.py': (),
+    'download_data.py': ('numpy', 'pandas', 'sklearn'),
+}, **{filename: ('nilearn.plotting', 'matplotlib')
+      for filename in FUNCTIONAL_FEATURE_EXTRACTORS})
+DEFAULT_LAZY_MODULES = ('nilearn', 'matplotlib')
+
+_IMPORT_CODE = """
+import importlib.util, json, sys, time
+t0 = time.time()
+spec = importlib.util.spec_from_file_location('module', {filename!r})
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+loaded = [name for name in {lazy_modules!r} if name in sys.modules]
+for estimator in ('FeatureExtractor', 'Classifier'):
+    if hasattr(module, estimator):
+        getattr(module, estimator)()
+duration = time.time() - t0
+print(json.dumps([duration, loaded]))
+"""
+
+
+def measure_import(filename, lazy_modules=(), n_repeat=3):
+    """Import a file and create its estimators in fresh interpreters.
+
+    Returns
+    -------
+    duration : float
+        The fastest time in seconds to import the file and create its
+        `FeatureExtractor` or `Classifier`.
+
+    loaded : list of str
+        The modules of `lazy_modules` loaded by the import.
+
+    """
+    code = _IMPORT_CODE.format(filename=os.path.abspath(filename),
+                               lazy_modules=list(lazy_modules))
+    durations = []
+    for _ in range(n_repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.abspath(filename)))
+        duration, loaded = json.loads(output.decode().splitlines()[-1])
+        durations.append(duration)
+    return min(durations), loaded
+
+
+def check_import_time(ramp_kit_dir='.', n_repeat=3):
+    """Return True if all the files are imported within their budget."""
+    filenames = ['problem.py', 'download_data.py'] + sorted(
+        os.path.relpath(filename, ramp_kit_dir) for filename in
+        glob.glob(os.path.join(ramp_kit_dir, 'submissions', '*', '*.py')))
+    success = True
+    for filename in filenames:
+        budget = BUDGET.get(filename, DEFAULT_BUDGET)
+        lazy_modules = LAZY_MODULES.get(filename, DEFAULT_LAZY_MODULES)
+        duration, loaded = measure_import(
+            os.path.join(ramp_kit_dir, filename), lazy_modules, n_repeat)
+        status = 'OK'
+        if duration > budget:
+            status = 'OVER BUDGET'
+        if loaded:
+            status = 'IMPORTS {}'.format(', '.join(loaded))
+        success &= status == 'OK'
+        print('{:<60} {:6.3f}s / {:.1f}s  {}'.format(
+            filename, duration, budget, status))
+    return success
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check that importing the problem, the scripts and the '
+        'submissions stays within a time budget.')
+    parser.add_argument('--ramp-kit-dir', default='.',
+                        help='Root directory of the ramp-kit.')
+    parser.add_argument('--n-repeat', type=int, default=3,
+                        help='Number of imports of each file.')
+    args = parser.parse_args()
+
+    if not check_import_time(args.ramp_kit_dir, args.n_repeat):
+        sys.exit(1)
@@ -14,11 +14,6 @@ try:
 except ImportError:
     from urllib import urlretrieve
 
-import numpy as np
-import pandas as pd
-# import joblib from scikit-learn to avoid an extra dependency
-from sklearn.externals import joblib
-
 ATLAS = ('basc064', 'basc122', 'basc197', 'craddock_scorr_mean',
          'harvard_oxford_cort_prob_2mm', 'msdl', 'power_2011')
 
@@ -78,6 +73,13 @@ def _download_fmri_data(atlas):
 
 
 def _check_integrity_atlas(atlas):
+    # the heavy modules are only imported when checking an atlas to keep the
+    # script responsive
+    import numpy as np
+    import pandas as pd
+    # import joblib from scikit-learn to avoid an extra dependency
+    from sklearn.externals import joblib
+
     # check that the folder is existing
     atlas_directory = os.path.abspath(os.path.join('.', 'data', 'fmri', atlas))
     if os.path.isdir(atlas_directory):
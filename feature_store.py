@@ -0,0 +1,317 @@
+# coding: utf-8
+"""On-disk store of precomputed features of the subjects.
+
+The features are stored by atlas, kind of connectivity and hash of the
+fitted preprocessing. Each entry is a directory holding blocks of subjects
+written as compressed numpy archives in which the features are split in
+chunks of columns. Reading a subset of subjects or of columns only
+decompresses the chunks containing them.
+
+The store also keeps the fitted attributes of the transformers, such as the
+reference of the tangent space, keyed by a hash of the transformer and of
+the training time series, so that fitting again on the same subjects is
+skipped. `StoredTransformer` plugs the store into the pipelines of the
+submissions computing the connectomes.
+
+A block is written in a temporary file which is renamed once complete and
+is never modified afterwards: several processes can read and write the same
+entry concurrently.
+"""
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import uuid
+
+import numpy as np
+
+from sklearn.base import clone
+
+
+class FeatureStore(object):
+    """Store of features computed for each subject.
+
+    Parameters
+    ----------
+    path : str
+        The root directory of the store.
+
+    block_size : int, default=64
+        The number of subjects in each block.
+
+    chunk_size : int, default=4096
+        The number of features in each chunk of a block.
+
+    """
+
+    def __init__(self, path, block_size=64, chunk_size=4096):
+        self.path = path
+        self.block_size = block_size
+        self.chunk_size = chunk_size
+
+    def _entry_dir(self, atlas, kind, preprocessing_hash):
+        return os.path.join(self.path, atlas, kind, preprocessing_hash)
+
+    def _read_meta(self, entry_dir):
+        try:
+            with open(os.path.join(entry_dir, 'meta.json')) as f:
+                return json.load(f)
+        except (IOError, OSError):
+            return None
+
+    def _make_dir(self, entry_dir):
+        if not os.path.isdir(entry_dir):
+            try:
+                os.makedirs(entry_dir)
+            except OSError:
+                # created by another process in the meantime
+                pass
+
+    def _atomic_write(self, entry_dir, filename, write):
+        fd, tmp_filename = tempfile.mkstemp(dir=entry_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.rename(tmp_filename, os.path.join(entry_dir, filename))
+
+    def write(self, atlas, kind, preprocessing_hash, subject_ids, features):
+        """Store the features of some subjects.
+
+        Parameters
+        ----------
+        atlas, kind, preprocessing_hash : str
+            The key of the features.
+
+        subject_ids : array-like, shape (n_subjects,)
+            The identifiers of the subjects.
+
+        features : array-like, shape (n_subjects, n_features)
+            The features, stored as float32.
+
+        """
+        features = np.asarray(features, dtype=np.float32)
+        subject_ids = np.array([str(subject_id) for subject_id in subject_ids])
+        entry_dir = self._entry_dir(atlas, kind, preprocessing_hash)
+        self._make_dir(entry_dir)
+
+        meta = self._read_meta(entry_dir)
+        if meta is None:
+            meta = {'n_features': features.shape[1],
+                    'chunk_size': self.chunk_size}
+            self._atomic_write(
+                entry_dir, 'meta.json',
+                lambda f: f.write(json.dumps(meta).encode('utf-8')))
+        elif meta['n_features'] != features.shape[1]:
+            raise ValueError('The store contains {} features for this key. '
+                             'Got {} features instead.'.format(
+                                 meta['n_features'], features.shape[1]))
+
+        chunk_size = meta['chunk_size']
+        for start in range(0, subject_ids.size, self.block_size):
+            block = features[start:start + self.block_size]
+            arrays = {
+                'chunk_{:05d}'.format(chunk_idx):
+                block[:, column_start:column_start + chunk_size]
+                for chunk_idx, column_start in enumerate(
+                    range(0, meta['n_features'], chunk_size))}
+            arrays['subject_ids'] = subject_ids[start:start + self.block_size]
+            self._atomic_write(
+                entry_dir, 'block_{}.npz'.format(uuid.uuid4().hex),
+                lambda f: np.savez_compressed(f, **arrays))
+
+    def read(self, atlas, kind, preprocessing_hash, subject_ids,
+             columns=None):
+        """Read the stored features of some subjects.
+
+        Parameters
+        ----------
+        atlas, kind, preprocessing_hash : str
+            The key of the features.
+
+        subject_ids : array-like, shape (n_subjects,)
+            The identifiers of the subjects.
+
+        columns : array-like of int, default=None
+            The indices of the features to read. By default, all features
+            are read.
+
+        Returns
+        -------
+        features : ndarray, shape (n_subjects, n_columns) or None
+            The features as float32, the rows of the subjects not stored
+            being filled with NaN. None if nothing is stored for this key.
+
+        found : ndarray of bool, shape (n_subjects,)
+            Whether the features of each subject are stored.
+
+        """
+        position = {str(subject_id): idx
+                    for idx, subject_id in enumerate(subject_ids)}
+        found = np.zeros(len(subject_ids), dtype=bool)
+        entry_dir = self._entry_dir(atlas, kind, preprocessing_hash)
+        meta = self._read_meta(entry_dir)
+        if meta is None:
+            return None, found
+
+        chunk_size = meta['chunk_size']
+        if columns is None:
+            columns = np.arange(meta['n_features'])
+        columns = np.asarray(columns)
+        column_chunks = columns // chunk_size
+        features = np.full((found.size, columns.size), np.nan,
+                           dtype=np.float32)
+        for filename in sorted(glob.glob(os.path.join(entry_dir,
+                                                      'block_*.npz'))):
+            with np.load(filename) as block:
+                rows_block, rows = [], []
+                for row_block, subject_id in enumerate(block['subject_ids']):
+                    row = position.get(subject_id)
+                    if row is not None and not found[row]:
+                        rows_block.append(row_block)
+                        rows.append(row)
+                if not rows:
+                    continue
+                for chunk_idx in np.unique(column_chunks):
+                    in_chunk = np.flatnonzero(column_chunks == chunk_idx)
+                    chunk = block['chunk_{:05d}'.format(chunk_idx)]
+                    chunk_columns = columns[in_chunk] - chunk_idx * chunk_size
+                    features[np.ix_(rows, in_chunk)] = chunk[
+                        np.ix_(rows_block, chunk_columns)]
+                found[rows] = True
+            if found.all():
+                break
+        return features, found
+
+    def write_fitted(self, atlas, kind, fit_hash, attributes):
+        """Store the fitted attributes of a transformer.
+
+        Parameters
+        ----------
+        atlas, kind, fit_hash : str
+            The key of the fitted transformer.
+
+        attributes : dict of str to ndarray
+            The fitted attributes.
+
+        """
+        fitted_dir = os.path.join(self.path, atlas, kind, 'fitted')
+        self._make_dir(fitted_dir)
+        self._atomic_write(fitted_dir, '{}.npz'.format(fit_hash),
+                           lambda f: np.savez(f, **attributes))
+
+    def read_fitted(self, atlas, kind, fit_hash):
+        """Read the stored fitted attributes of a transformer.
+
+        Returns
+        -------
+        attributes : dict of str to ndarray or None
+            The fitted attributes. None if nothing is stored for this key.
+
+        """
+        filename = os.path.join(self.path, atlas, kind, 'fitted',
+                                '{}.npz'.format(fit_hash))
+        try:
+            with np.load(filename) as fitted:
+                return {name: fitted[name] for name in fitted.files}
+        except (IOError, OSError):
+            return None
+
+
+def _time_series_ids(fmri_filenames):
+    """Identify the time series by the name, size and time of their file.
+
+    A file downloaded again gets a new identifier.
+    """
+    ids = []
+    for filename in fmri_filenames:
+        stat = os.stat(filename)
+        ids.append('{}:{}:{}'.format(filename, stat.st_size,
+                                     stat.st_mtime_ns))
+    return np.array(ids)
+
+
+def _atlas(fmri_filenames):
+    # the time series are stored in data/fmri/<atlas>/<subject>/run_1/
+    atlases = set(
+        os.path.basename(os.path.dirname(os.path.dirname(
+            os.path.dirname(os.path.abspath(filename)))))
+        for filename in fmri_filenames)
+    return '+'.join(sorted(atlases))
+
+
+class StoredTransformer(object):
+    """Fit and apply a pipeline computing connectomes with a feature store.
+
+    The fitted attributes of the pipeline are read from the store if it was
+    already fitted on the same time series and the connectomes already
+    computed by the same fitted pipeline are read from the store. Everything
+    else is computed and added to the store.
+
+    Parameters
+    ----------
+    transformer : Pipeline
+        The pipeline computing the connectomes from the file names of the
+        time series, whose last step is a `ConnectivityMeasure`. It is fitted
+        in place.
+
+    path : str, default=None
+        The root directory of the store. By default, the environment
+        variable `AUTISM_FEATURE_STORE`.
+
+    """
+
+    def __init__(self, transformer, path=None):
+        if path is None:
+            path = os.environ['AUTISM_FEATURE_STORE']
+        self.transformer = transformer
+        self.store = FeatureStore(path)
+
+    def _kind(self):
+        return self.transformer.steps[-1][1].kind
+
+    def _fitted_attributes(self):
+        return {'{}__{}'.format(step_idx, name): value
+                for step_idx, (_, step) in enumerate(self.transformer.steps)
+                for name, value in vars(step).items()
+                if name.endswith('_') and isinstance(value, np.ndarray)}
+
+    def fit(self, fmri_filenames, y=None):
+        series_ids = _time_series_ids(fmri_filenames)
+        fit_hash = hashlib.sha256('\n'.join(
+            [repr(self.transformer.steps[1:])] + sorted(series_ids))
+            .encode('utf-8')).hexdigest()
+        atlas = _atlas(fmri_filenames)
+        attributes = self.store.read_fitted(atlas, self._kind(), fit_hash)
+        if attributes is None:
+            self.transformer.fit(fmri_filenames, y)
+            self.store.write_fitted(atlas, self._kind(), fit_hash,
+                                    self._fitted_attributes())
+            return self
+        for _, step in self.transformer.steps:
+            if hasattr(step, 'cov_estimator'):
+                step.cov_estimator_ = clone(step.cov_estimator)
+        for key, value in attributes.items():
+            step_idx, name = key.split('__', 1)
+            setattr(self.transformer.steps[int(step_idx)][1], name, value)
+        return self
+
+    def transform(self, fmri_filenames):
+        """Return the connectomes of the subjects as float32."""
+        series_ids = _time_series_ids(fmri_filenames)
+        preprocessing_hash = hashlib.sha256(
+            repr(self.transformer.steps[1:]).encode('utf-8'))
+        for key, value in sorted(self._fitted_attributes().items()):
+            preprocessing_hash.update(key.encode('utf-8'))
+            preprocessing_hash.update(np.ascontiguousarray(value).tobytes())
+        key = (_atlas(fmri_filenames), self._kind(),
+               preprocessing_hash.hexdigest())
+        X, found = self.store.read(*key, subject_ids=series_ids)
+        if found.all():
+            return X
+        X_missing = self.transformer.transform(fmri_filenames[~found])
+        self.store.write(*key, subject_ids=series_ids[~found],
+                         features=X_missing)
+        if X is None:
+            return np.asarray(X_missing, dtype=np.float32)
+        X[~found] = X_missing
+        return X
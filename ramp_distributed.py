@@ -0,0 +1,591 @@
+# coding: utf-8
+"""Evaluate submissions on the cross-validation folds with remote workers.
+
+Each (submission, atlas, fold) combination is a task put in a queue. Workers
+running on any machine claim the tasks, train and score the submission on
+the fold and push back the score table computed by `ramp-workflow`. Two
+queue backends are available:
+
+* `'sqlite'`: a SQLite database, to be used by workers on a single machine;
+* `'filesystem'`: a directory of task files claimed with atomic renames, to
+  be used by workers on several machines sharing a file system.
+
+The tasks only contain the path of the kit and of the data: each worker
+reads the data from disk once and keeps it for the following tasks. While a
+task runs, its worker regularly renews its lease on the task; a task whose
+lease expired, e.g. because its worker died, is given to another worker.
+
+With the atlas `'default'`, the submissions use the atlases they were written
+for. Other atlases are evaluated for the submissions reading the time series
+from the `'fmri_msdl'` column: this column is replaced by the file names of
+the requested atlas and the columns of the other atlases are removed, such
+that a submission using several atlases fails instead of being scored on the
+wrong atlas.
+
+Usage on a single machine::
+
+    python ramp_distributed.py local --submissions starting_kit_functional \
+        --atlas msdl basc064 --n-workers 4
+
+Usage on several machines::
+
+    python ramp_distributed.py submit --backend filesystem --queue /shared/q \
+        --submissions starting_kit_functional --atlas msdl basc064
+    python ramp_distributed.py worker --backend filesystem --queue /shared/q
+    python ramp_distributed.py collect --backend filesystem --queue /shared/q
+
+The commands exit with an error if a task failed or, for `local` and
+`collect`, if no score was collected.
+"""
+from __future__ import print_function
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+
+import pandas as pd
+import rampwf as rw
+from rampwf.utils.pretty_print import print_df_scores, print_title
+from rampwf.utils.scoring import mean_score_matrix
+
+from download_data import ATLAS
+
+# seconds after which a task whose worker stopped renewing its lease is
+# given to another worker
+LEASE = 600
+MAX_RETRIES = 2
+
+
+class QueueBackend(object):
+    """Interface of the queue shared by the submitter and the workers.
+
+    A task is a dictionary holding at least the key `'task_id'`. Each time
+    a task is claimed, its number of attempts is incremented. A task which
+    failed is put back in the queue until it was attempted more than
+    `max_retries` times.
+
+    Parameters
+    ----------
+    path : str
+        The location of the queue.
+
+    max_retries : int, default=MAX_RETRIES
+        The number of times a failed task is retried.
+
+    lease : float, default=LEASE
+        The number of seconds after which a claimed task whose lease was not
+        renewed is considered lost and claimed again.
+
+    """
+
+    def __init__(self, path, max_retries=MAX_RETRIES, lease=LEASE):
+        self.path = path
+        self.max_retries = max_retries
+        self.lease = lease
+
+    def submit(self, tasks):
+        """Add a list of tasks to the queue.
+
+        The tasks already in the queue are left untouched.
+        """
+        raise NotImplementedError
+
+    def claim(self, worker):
+        """Return the next task to run or None if no task is available."""
+        raise NotImplementedError
+
+    def renew(self, task, worker):
+        """Extend the lease of a worker on a running task."""
+        raise NotImplementedError
+
+    def complete(self, task, result):
+        """Store the result, a string, of a task."""
+        raise NotImplementedError
+
+    def fail(self, task, error):
+        """Put back a task in the queue or mark it as failed."""
+        raise NotImplementedError
+
+    def n_unfinished(self):
+        """Return the number of tasks pending or running."""
+        raise NotImplementedError
+
+    def results(self):
+        """Return the list of `(task, result)` of the completed tasks."""
+        raise NotImplementedError
+
+    def failures(self):
+        """Return the list of `(task, error)` of the failed tasks."""
+        raise NotImplementedError
+
+
+class SQLiteBackend(QueueBackend):
+    """Queue stored in a SQLite database on a local file system."""
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=60,
+                                     isolation_level=None)
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS tasks ('
+            'task_id TEXT PRIMARY KEY, payload TEXT, status TEXT, '
+            'attempts INTEGER, worker TEXT, claimed_at REAL, result TEXT)')
+        return connection
+
+    def submit(self, tasks):
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO tasks VALUES (?, ?, 'pending', 0, "
+                "NULL, NULL, NULL)",
+                [(task['task_id'], json.dumps(task)) for task in tasks])
+        connection.close()
+
+    def claim(self, worker):
+        connection = self._connect()
+        try:
+            # lock the database for writing until the task is marked running
+            connection.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            connection.execute(
+                "UPDATE tasks SET status = 'failed', "
+                "result = 'Lease expired too many times.' "
+                "WHERE status = 'running' AND claimed_at < ? "
+                "AND attempts > ?", (now - self.lease, self.max_retries))
+            row = connection.execute(
+                "SELECT task_id, payload, attempts FROM tasks "
+                "WHERE status = 'pending' "
+                "OR (status = 'running' AND claimed_at < ?) "
+                "ORDER BY rowid LIMIT 1", (now - self.lease,)).fetchone()
+            if row is None:
+                connection.execute('COMMIT')
+                return None
+            task_id, payload, attempts = row
+            connection.execute(
+                "UPDATE tasks SET status = 'running', attempts = ?, "
+                "worker = ?, claimed_at = ? WHERE task_id = ?",
+                (attempts + 1, worker, now, task_id))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        finally:
+            connection.close()
+        task = json.loads(payload)
+        task['attempts'] = attempts + 1
+        return task
+
+    def renew(self, task, worker):
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "UPDATE tasks SET claimed_at = ? WHERE task_id = ? "
+                "AND worker = ? AND status = 'running'",
+                (time.time(), task['task_id'], worker))
+        connection.close()
+
+    def complete(self, task, result):
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "UPDATE tasks SET status = 'done', result = ? "
+                "WHERE task_id = ?", (result, task['task_id']))
+        connection.close()
+
+    def fail(self, task, error):
+        status = ('pending' if task['attempts'] <= self.max_retries
+                  else 'failed')
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "UPDATE tasks SET status = ?, result = ? WHERE task_id = ?",
+                (status, error, task['task_id']))
+        connection.close()
+
+    def _select(self, status):
+        connection = self._connect()
+        rows = connection.execute(
+            "SELECT payload, attempts, result FROM tasks WHERE status = ? "
+            "ORDER BY rowid", (status,)).fetchall()
+        connection.close()
+        tasks = []
+        for payload, attempts, result in rows:
+            task = json.loads(payload)
+            task['attempts'] = attempts
+            tasks.append((task, result))
+        return tasks
+
+    def n_unfinished(self):
+        connection = self._connect()
+        n_tasks, = connection.execute(
+            "SELECT COUNT(*) FROM tasks WHERE status IN "
+            "('pending', 'running')").fetchone()
+        connection.close()
+        return n_tasks
+
+    def results(self):
+        return self._select('done')
+
+    def failures(self):
+        return self._select('failed')
+
+
+class FileSystemBackend(QueueBackend):
+    """Queue stored as files in a directory shared by several machines.
+
+    A task is claimed by renaming its file from the `pending` to the
+    `running` folder: the rename is atomic, therefore a single worker
+    succeeds. The results are written in the `done` and `failed` folders.
+
+    """
+
+    _FOLDERS = ('pending', 'running', 'done', 'failed')
+
+    def __init__(self, path, max_retries=MAX_RETRIES, lease=LEASE):
+        super(FileSystemBackend, self).__init__(path, max_retries, lease)
+        for folder in self._FOLDERS:
+            if not os.path.isdir(os.path.join(path, folder)):
+                os.makedirs(os.path.join(path, folder))
+
+    def _filename(self, folder, task):
+        return os.path.join(self.path, folder, task['task_id'] + '.json')
+
+    def _write(self, folder, task, **kwargs):
+        record = dict(task=task, **kwargs)
+        # write in a temporary file first to never expose a partial file
+        fd, tmp_filename = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(record, f)
+        os.rename(tmp_filename, self._filename(folder, task))
+
+    def _read(self, filename):
+        with open(filename) as f:
+            return json.load(f)
+
+    def submit(self, tasks):
+        for task in tasks:
+            if not any(os.path.exists(self._filename(folder, task))
+                       for folder in self._FOLDERS):
+                self._write('pending', task)
+
+    def _requeue_expired(self):
+        now = time.time()
+        for filename in glob.glob(os.path.join(self.path, 'running',
+                                               '*.json')):
+            try:
+                if now - os.path.getmtime(filename) < self.lease:
+                    continue
+                record = self._read(filename)
+                os.remove(filename)
+            except (IOError, OSError, ValueError):
+                # another worker already took care of it
+                continue
+            self.fail(record['task'], 'Lease expired.')
+
+    def claim(self, worker):
+        self._requeue_expired()
+        for filename in sorted(glob.glob(os.path.join(self.path, 'pending',
+                                                      '*.json'))):
+            running_filename = os.path.join(self.path, 'running',
+                                            os.path.basename(filename))
+            try:
+                os.rename(filename, running_filename)
+                # the modification time of the running file starts the lease
+                # and the rename keeps the one of the pending file
+                os.utime(running_filename, None)
+            except OSError:
+                # the task was claimed by another worker
+                continue
+            task = self._read(running_filename)['task']
+            task['attempts'] = task.get('attempts', 0) + 1
+            self._write('running', task, worker=worker)
+            return task
+        return None
+
+    def renew(self, task, worker):
+        try:
+            os.utime(self._filename('running', task), None)
+        except OSError:
+            # the lease already expired and the task was requeued
+            pass
+
+    def complete(self, task, result):
+        self._write('done', task, result=result)
+        self._remove_running(task)
+
+    def fail(self, task, error):
+        if task['attempts'] <= self.max_retries:
+            self._write('pending', task, error=error)
+        else:
+            self._write('failed', task, result=error)
+        self._remove_running(task)
+
+    def _remove_running(self, task):
+        try:
+            os.remove(self._filename('running', task))
+        except OSError:
+            pass
+
+    def _select(self, folder):
+        records = [self._read(filename) for filename in sorted(
+            glob.glob(os.path.join(self.path, folder, '*.json')))]
+        return [(record['task'], record['result']) for record in records]
+
+    def n_unfinished(self):
+        return sum(len(glob.glob(os.path.join(self.path, folder, '*.json')))
+                   for folder in ('pending', 'running'))
+
+    def results(self):
+        return self._select('done')
+
+    def failures(self):
+        return self._select('failed')
+
+
+BACKENDS = {'sqlite': SQLiteBackend,
+            'filesystem': FileSystemBackend}
+
+
+def make_tasks(submissions, atlases, n_folds, ramp_kit_dir='.',
+               ramp_data_dir='.', ramp_submission_dir='submissions'):
+    """Create a task for each combination of submission, atlas and fold."""
+    ramp_kit_dir = os.path.abspath(ramp_kit_dir)
+    ramp_data_dir = os.path.abspath(ramp_data_dir)
+    ramp_submission_dir = os.path.abspath(ramp_submission_dir)
+    return [dict(task_id='{}_{}_{:03d}'.format(submission, atlas, fold),
+                 submission=submission, atlas=atlas, fold=fold,
+                 ramp_kit_dir=ramp_kit_dir, ramp_data_dir=ramp_data_dir,
+                 ramp_submission_dir=ramp_submission_dir)
+            for submission in submissions
+            for atlas in atlases
+            for fold in range(n_folds)]
+
+
+# data loaded by a worker, reused by the following tasks
+_DATA_CACHE = {}
+
+
+def _load_data(ramp_kit_dir, ramp_data_dir):
+    key = (ramp_kit_dir, ramp_data_dir)
+    if key not in _DATA_CACHE:
+        problem = rw.utils.assert_read_problem(ramp_kit_dir)
+        X_train, y_train = problem.get_train_data(path=ramp_data_dir)
+        X_test, y_test = problem.get_test_data(path=ramp_data_dir)
+        cv = list(problem.get_cv(X_train, y_train))
+        _DATA_CACHE[key] = (problem, X_train, y_train, X_test, y_test, cv)
+    return _DATA_CACHE[key]
+
+
+def _select_atlas(X_df, atlas):
+    if atlas == 'default':
+        return X_df
+    X_df = X_df.copy()
+    X_df['fmri_msdl'] = X_df['fmri_{}'.format(atlas)]
+    return X_df.drop(columns=['fmri_{}'.format(other_atlas)
+                              for other_atlas in ATLAS
+                              if other_atlas != 'msdl'],
+                     errors='ignore')
+
+
+def run_task(task):
+    """Train and score a submission on a fold and return the scores."""
+    problem, X_train, y_train, X_test, y_test, cv = _load_data(
+        task['ramp_kit_dir'], task['ramp_data_dir'])
+    # the file names of the time series are relative to the data directory
+    os.chdir(task['ramp_data_dir'])
+    _, _, df_scores = rw.utils.run_submission_on_cv_fold(
+        problem,
+        os.path.join(task['ramp_submission_dir'], task['submission']),
+        cv[task['fold']],
+        _select_atlas(X_train, task['atlas']), y_train,
+        _select_atlas(X_test, task['atlas']), y_test)
+    return df_scores
+
+
+def _renew_lease(backend, task, worker, stop):
+    # renew the lease often enough for it not to expire while the task runs
+    while not stop.wait(backend.lease / 3.):
+        backend.renew(task, worker)
+
+
+def run_worker(backend, worker=None, poll_interval=5.):
+    """Run the tasks of the queue until none is pending nor running."""
+    if worker is None:
+        worker = '{}-{}'.format(socket.gethostname(), os.getpid())
+    while True:
+        task = backend.claim(worker)
+        if task is None:
+            if backend.n_unfinished() == 0:
+                return
+            # tasks still running elsewhere might come back on failure
+            time.sleep(poll_interval)
+            continue
+        print_title('{} claimed {}'.format(worker, task['task_id']))
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=_renew_lease,
+                                     args=(backend, task, worker, stop))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            df_scores = run_task(task)
+        # ramp-workflow exits when a submission raises an error
+        except (Exception, SystemExit):
+            error = traceback.format_exc()
+            df_scores = None
+        finally:
+            stop.set()
+            heartbeat.join()
+        if df_scores is None:
+            backend.fail(task, error)
+        else:
+            backend.complete(task, df_scores.to_json())
+
+
+def collect_scores(backend):
+    """Gather the score tables of the completed tasks.
+
+    Returns
+    -------
+    df_scores : pd.DataFrame
+        The scores indexed by submission, atlas, fold and step (train,
+        valid, test).
+
+    """
+    df_scores_list = []
+    for task, result in backend.results():
+        df_scores = pd.DataFrame(json.loads(result))
+        df_scores.index.name = 'step'
+        df_scores = df_scores.reset_index()
+        for key in ('submission', 'atlas', 'fold'):
+            df_scores[key] = task[key]
+        df_scores_list.append(df_scores)
+    if not df_scores_list:
+        return pd.DataFrame()
+    return (pd.concat(df_scores_list, ignore_index=True)
+            .set_index(['submission', 'atlas', 'fold', 'step'])
+            .sort_index())
+
+
+_STEPS = ['train', 'valid', 'test']
+
+
+def print_scores(df_scores, score_types):
+    """Print the mean CV scores of each submission and atlas."""
+    for (submission, atlas), df in df_scores.groupby(level=[0, 1]):
+        print_title('----------------------------')
+        print_title('Mean CV scores: {} ({})'.format(submission, atlas))
+        print_title('----------------------------')
+        df_scores_list = [
+            df_fold.reset_index(level=[0, 1, 2], drop=True).loc[_STEPS]
+            for _, df_fold in df.groupby(level=2)]
+        print_df_scores(mean_score_matrix(df_scores_list, score_types),
+                        indent='\t')
+
+
+def _collect(backend, ramp_kit_dir, output):
+    """Print the scores and return False if a task failed or none is done."""
+    failures = backend.failures()
+    for task, error in failures:
+        print_title('Task {} failed after {} attempts:'.format(
+            task['task_id'], task['attempts']))
+        print(error)
+    df_scores = collect_scores(backend)
+    if df_scores.empty:
+        print_title('No scores were collected.')
+        return False
+    problem = rw.utils.assert_read_problem(ramp_kit_dir)
+    print_scores(df_scores, problem.score_types)
+    if output is not None:
+        df_scores.to_csv(output)
+    return not failures
+
+
+def _submit(backend, submissions, atlases, ramp_kit_dir, ramp_data_dir):
+    problem = rw.utils.assert_read_problem(ramp_kit_dir)
+    X_train, y_train = problem.get_train_data(path=ramp_data_dir)
+    n_folds = len(list(problem.get_cv(X_train, y_train)))
+    backend.submit(make_tasks(submissions, atlases, n_folds, ramp_kit_dir,
+                              ramp_data_dir))
+
+
+def _worker_process(backend_name, queue, max_retries, lease):
+    run_worker(BACKENDS[backend_name](queue, max_retries=max_retries,
+                                      lease=lease))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Evaluate submissions on the cross-validation folds '
+        'using several workers.')
+    parser.add_argument('command',
+                        choices=('submit', 'worker', 'collect', 'local'),
+                        help='"submit" queues the tasks, "worker" runs '
+                        'them, "collect" prints the scores and "local" does '
+                        'all of it with a local SQLite queue.')
+    parser.add_argument('--backend', default='sqlite',
+                        choices=sorted(BACKENDS),
+                        help='Type of queue shared with the workers.')
+    parser.add_argument('--queue', default=None,
+                        help='Path of the queue.')
+    parser.add_argument('--submissions', nargs='+', default=[],
+                        help='Names of the submissions to evaluate.')
+    parser.add_argument('--atlas', nargs='+', default=['default'],
+                        choices=('default',) + ATLAS,
+                        help='Names of the atlases to evaluate. "default" '
+                        'uses the atlases chosen by the submissions.')
+    parser.add_argument('--n-workers', type=int, default=1,
+                        help='Number of worker processes with "local".')
+    parser.add_argument('--max-retries', type=int, default=MAX_RETRIES,
+                        help='Number of times a failed task is retried.')
+    parser.add_argument('--lease', type=float, default=LEASE,
+                        help='Number of seconds after which a task whose '
+                        'worker stopped renewing its lease is run by another '
+                        'worker.')
+    parser.add_argument('--ramp-kit-dir', default='.',
+                        help='Root directory of the ramp-kit.')
+    parser.add_argument('--ramp-data-dir', default='.',
+                        help='Directory containing the data.')
+    parser.add_argument('--output', default=None,
+                        help='CSV file where to save the scores.')
+    args = parser.parse_args()
+
+    queue = args.queue
+    if args.command == 'local':
+        args.backend = 'sqlite'
+        if queue is None:
+            queue = os.path.join(tempfile.mkdtemp(),
+                                 'queue_{}.db'.format(uuid.uuid4().hex))
+    elif queue is None:
+        parser.error('--queue is required for "{}".'.format(args.command))
+    backend = BACKENDS[args.backend](queue, max_retries=args.max_retries,
+                                     lease=args.lease)
+
+    if args.command in ('submit', 'local'):
+        _submit(backend, args.submissions, args.atlas, args.ramp_kit_dir,
+                args.ramp_data_dir)
+    success = True
+    if args.command == 'worker':
+        run_worker(backend)
+        success = not backend.failures()
+    if args.command == 'local':
+        workers = [multiprocessing.Process(
+            target=_worker_process,
+            args=(args.backend, queue, args.max_retries, args.lease))
+            for _ in range(args.n_workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    if args.command in ('collect', 'local'):
+        success = _collect(backend, args.ramp_kit_dir, args.output)
+    if not success:
+        sys.exit(1)
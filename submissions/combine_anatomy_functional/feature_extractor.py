@@ -1,3 +1,5 @@
+import os
+
 import numpy as np
 import pandas as pd
 
@@ -5,7 +7,7 @@ from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import FunctionTransformer
 
-from nilearn.connectome import ConnectivityMeasure
+from nilearn.connectome import ConnectivityMeasure, GroupSparseCovariance
 
 
 def _load_fmri(fmri_filenames):
@@ -15,22 +17,211 @@ def _load_fmri(fmri_filenames):
                      for subject_filename in fmri_filenames])
 
 
+def _with_store(transformer_fmri):
+    """Reuse the connectomes of a feature store, if one is given.
+
+    The store is set by the environment variable `AUTISM_FEATURE_STORE` and
+    implemented in `feature_store.py`, at the root of the kit which should
+    then be in the python path.
+    """
+    if 'AUTISM_FEATURE_STORE' not in os.environ:
+        return transformer_fmri
+    from feature_store import StoredTransformer
+    return StoredTransformer(transformer_fmri)
+
+
+def _shrunk_covariances(time_series, estimator='ledoit_wolf'):
+    """Compute the shrunk covariances of time series of the same length.
+
+    Parameters
+    ----------
+    time_series : ndarray, shape (n_subjects, n_samples, n_regions)
+        The time series of the subjects.
+
+    estimator : {'ledoit_wolf', 'oas'}, default='ledoit_wolf'
+        The formula used to compute the shrinkage of each subject.
+
+    Returns
+    -------
+    covariances : ndarray, shape (n_subjects, n_regions, n_regions)
+        The shrunk covariances.
+
+    """
+    n_samples, n_regions = time_series.shape[1:]
+    time_series = time_series - time_series.mean(axis=1, keepdims=True)
+    emp_covs = np.matmul(time_series.transpose(0, 2, 1),
+                         time_series) / n_samples
+    mu = np.trace(emp_covs, axis1=1, axis2=2) / n_regions
+    if estimator == 'ledoit_wolf':
+        # the sum of the products of squared signals only depends on the
+        # squared norm of each sample
+        beta = np.sum(np.sum(time_series ** 2, axis=2) ** 2, axis=1)
+        delta = np.sum(emp_covs ** 2, axis=(1, 2))
+        beta = (beta / n_samples - delta) / (n_regions * n_samples)
+        delta = (delta - n_regions * mu ** 2) / n_regions
+        beta = np.minimum(beta, delta)
+        shrinkage = np.where(beta == 0, 0., beta / np.where(delta == 0, 1.,
+                                                            delta))
+    else:
+        alpha = np.mean(emp_covs ** 2, axis=(1, 2))
+        num = alpha + mu ** 2
+        den = (n_samples + 1.) * (alpha - mu ** 2 / n_regions)
+        shrinkage = np.where(den == 0, 1., np.minimum(
+            num / np.where(den == 0, 1., den), 1.))
+    shrinkage = shrinkage[:, np.newaxis, np.newaxis]
+    return ((1. - shrinkage) * emp_covs +
+            shrinkage * mu[:, np.newaxis, np.newaxis] * np.eye(n_regions))
+
+
+def _sparse_precision_covariances(covariances, support, max_iter=100,
+                                  tol=1e-4):
+    """Estimate covariances whose inverse is zero outside of a support.
+
+    The covariances of all the subjects are updated at once, column by
+    column, as in the algorithm 17.1 of [1]_: each covariance keeps its
+    values on the support and its inverse is zero elsewhere.
+
+    Parameters
+    ----------
+    covariances : ndarray, shape (n_subjects, n_regions, n_regions)
+        The covariances of the subjects.
+
+    support : ndarray of bool, shape (n_regions, n_regions)
+        The non-zero entries of the precisions.
+
+    Returns
+    -------
+    covariances : ndarray, shape (n_subjects, n_regions, n_regions)
+        The covariances with a sparse inverse.
+
+    References
+    ----------
+    .. [1] Hastie, Trevor, et al. "The elements of statistical learning."
+       Springer, 2nd edition (2009).
+
+    """
+    n_regions = covariances.shape[1]
+    estimates = covariances.copy()
+    for _ in range(max_iter):
+        change = 0.
+        for region in range(n_regions):
+            others = np.delete(np.arange(n_regions), region)
+            neighbors = others[support[region, others]]
+            if neighbors.size:
+                coefs = np.linalg.solve(
+                    estimates[:, neighbors][:, :, neighbors],
+                    covariances[:, neighbors, region][..., np.newaxis])
+                column = np.matmul(estimates[:, others][:, :, neighbors],
+                                   coefs)[..., 0]
+            else:
+                column = np.zeros((estimates.shape[0], others.size))
+            change = max(change,
+                         np.max(np.abs(column - estimates[:, others, region])))
+            estimates[:, others, region] = column
+            estimates[:, region, others] = column
+        if change < tol * np.max(np.abs(covariances)):
+            break
+    return estimates
+
+
+class ShrunkCovariances(BaseEstimator, TransformerMixin):
+    """Estimate the covariance of the time series of all the subjects.
+
+    Parameters
+    ----------
+    estimator : {'ledoit_wolf', 'oas', 'group_sparse'}, default='ledoit_wolf'
+        With `'ledoit_wolf'` and `'oas'`, each empirical covariance is shrunk
+        towards a scaled identity; the subjects with the same number of
+        samples are stacked and estimated together. With `'group_sparse'`,
+        the sparsity pattern shared by the precisions of the training
+        subjects is estimated in `fit` [1]_. The Ledoit-Wolf covariance of
+        each subject is then estimated under this pattern, its inverse being
+        zero outside of it: the sparse precisions are given by
+        `ConnectivityMeasure(kind='precision')`.
+
+    alpha : float, default=0.1
+        The regularization of the `'group_sparse'` estimator.
+
+    References
+    ----------
+    .. [1] Varoquaux, Gael, et al. "Brain covariance selection: better
+       individual functional connectivity models using population prior."
+       Advances in Neural Information Processing Systems. 2010.
+
+    """
+
+    def __init__(self, estimator='ledoit_wolf', alpha=0.1):
+        self.estimator = estimator
+        self.alpha = alpha
+
+    def fit(self, X, y=None):
+        if self.estimator == 'group_sparse':
+            # the pattern is only learnt from the training subjects and each
+            # subject is then estimated on its own
+            precisions = GroupSparseCovariance(alpha=self.alpha).fit(
+                list(X)).precisions_
+            self.support_ = np.any(precisions != 0, axis=2)
+        return self
+
+    def transform(self, X):
+        if self.estimator not in ('ledoit_wolf', 'oas', 'group_sparse'):
+            raise ValueError("'estimator' should be one of 'ledoit_wolf', "
+                             "'oas' or 'group_sparse'. Got {} instead."
+                             .format(self.estimator))
+        estimator = self.estimator
+        if estimator == 'group_sparse':
+            estimator = 'ledoit_wolf'
+        covariances = [None] * len(X)
+        n_samples = np.array([time_series.shape[0] for time_series in X])
+        for n_samples_batch in np.unique(n_samples):
+            subject_idx = np.flatnonzero(n_samples == n_samples_batch)
+            batch_covariances = _shrunk_covariances(
+                np.stack([X[idx] for idx in subject_idx]), estimator)
+            for idx, covariance in zip(subject_idx, batch_covariances):
+                covariances[idx] = covariance
+        if self.estimator == 'group_sparse':
+            covariances = list(_sparse_precision_covariances(
+                np.array(covariances), self.support_))
+        return covariances
+
+
+class _PrecomputedCovariance(BaseEstimator):
+    """Covariance estimator for inputs which already are covariances."""
+
+    def fit(self, X, y=None):
+        try:
+            np.linalg.cholesky(X)
+        except np.linalg.LinAlgError:
+            # the standardization of the covariances done by
+            # ConnectivityMeasure(kind='correlation') makes them singular
+            raise ValueError("The precomputed covariance is not positive "
+                             "definite. Note that it cannot be used with "
+                             "ConnectivityMeasure(kind='correlation'): use "
+                             "kind='covariance' and convert the covariances "
+                             "to correlations instead.")
+        self.covariance_ = X
+        return self
+
+
 class FeatureExtractor(BaseEstimator, TransformerMixin):
     def __init__(self):
         # make a transformer which will load the time series and compute the
         # connectome matrix
         self.transformer_fmri = make_pipeline(
             FunctionTransformer(func=_load_fmri, validate=False),
-            ConnectivityMeasure(kind='tangent', vectorize=True))
+            ShrunkCovariances(estimator='ledoit_wolf'),
+            ConnectivityMeasure(cov_estimator=_PrecomputedCovariance(),
+                                kind='tangent', vectorize=True))
 
     def fit(self, X_df, y):
         fmri_filenames = X_df['fmri_msdl']
-        self.transformer_fmri.fit(fmri_filenames, y)
+        _with_store(self.transformer_fmri).fit(fmri_filenames, y)
         return self
 
     def transform(self, X_df):
         fmri_filenames = X_df['fmri_msdl']
-        X_connectome = self.transformer_fmri.transform(fmri_filenames)
+        X_connectome = _with_store(self.transformer_fmri).transform(
+            fmri_filenames)
         X_connectome = pd.DataFrame(X_connectome, index=X_df.index)
         X_connectome.columns = ['connectome_{}'.format(i)
                                 for i in range(X_connectome.columns.size)]
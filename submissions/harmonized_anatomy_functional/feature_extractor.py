@@ -0,0 +1,200 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import FunctionTransformer
+
+from nilearn.connectome import ConnectivityMeasure
+
+
+def _load_fmri(fmri_filenames):
+    """Load time-series extracted from the fMRI using a specific atlas."""
+    return np.array([pd.read_csv(subject_filename,
+                                 header=None).values
+                     for subject_filename in fmri_filenames])
+
+
+def _with_store(transformer_fmri):
+    """Reuse the connectomes of a feature store, if one is given.
+
+    The store is set by the environment variable `AUTISM_FEATURE_STORE` and
+    implemented in `feature_store.py`, at the root of the kit which should
+    then be in the python path.
+    """
+    if 'AUTISM_FEATURE_STORE' not in os.environ:
+        return transformer_fmri
+    from feature_store import StoredTransformer
+    return StoredTransformer(transformer_fmri)
+
+
+class ComBat(BaseEstimator, TransformerMixin):
+    """Remove the additive and multiplicative site effects of each feature.
+
+    The site location and scale parameters of all features are estimated at
+    once and shrunk towards a prior shared by the features with an empirical
+    Bayes procedure [1]_. Subjects from a site unseen during ``fit``, or from
+    a site with less than ``min_site_size`` training subjects, are returned
+    unchanged.
+
+    Parameters
+    ----------
+    min_site_size : int, default=2
+        Minimum number of training subjects required to estimate the effects
+        of a site.
+
+    max_iter : int, default=100
+        Maximum number of iterations of the empirical Bayes estimation.
+
+    tol : float, default=1e-4
+        Tolerance on the relative change of the site parameters used to stop
+        the empirical Bayes estimation.
+
+    References
+    ----------
+    .. [1] Johnson, W. Evan, et al. "Adjusting batch effects in microarray
+       expression data using empirical Bayes methods." Biostatistics 8.1
+       (2007): 118-127.
+
+    """
+
+    def __init__(self, min_site_size=2, max_iter=100, tol=1e-4):
+        self.min_site_size = min_site_size
+        self.max_iter = max_iter
+        self.tol = tol
+
+    def fit(self, X, sites):
+        if self.min_site_size < 2:
+            raise ValueError("'min_site_size' should be at least 2. Got {} "
+                             "instead.".format(self.min_site_size))
+        X = np.asarray(X, dtype=np.float64)
+        sites = np.asarray(sites)
+        eps = np.finfo(np.float64).eps
+
+        site_labels, site_idx, site_counts = np.unique(
+            sites, return_inverse=True, return_counts=True)
+        keep_site = site_counts >= self.min_site_size
+        self.sites_ = site_labels[keep_site]
+        keep_subject = keep_site[site_idx]
+        X = X[keep_subject]
+        # one-hot encoding of the sites, shape (n_sites, n_subjects)
+        design = (site_idx[keep_subject] ==
+                  np.flatnonzero(keep_site)[:, np.newaxis]).astype(np.float64)
+        n_subjects_site = design.sum(axis=1)[:, np.newaxis]
+
+        # standardize the features using the pooled within-site variance
+        self.mean_ = X.mean(axis=0)
+        site_mean = design.dot(X) / n_subjects_site
+        var_pooled = np.mean((X - design.T.dot(site_mean)) ** 2, axis=0)
+        var_pooled[var_pooled < eps] = 1.
+        self.scale_ = np.sqrt(var_pooled)
+        Z = (X - self.mean_) / self.scale_
+
+        # method of moments estimates of the site effects and their priors
+        sum_z = design.dot(Z)
+        sum_z2 = design.dot(Z ** 2)
+        gamma_hat = sum_z / n_subjects_site
+        delta_hat = ((sum_z2 - n_subjects_site * gamma_hat ** 2) /
+                     (n_subjects_site - 1))
+        delta_hat = np.maximum(delta_hat, eps)
+        if self.sites_.size < 2 or X.shape[1] < 2:
+            # the priors are estimated across the sites and the features
+            self.gamma_, self.delta_ = gamma_hat, delta_hat
+            self.n_iter_ = 0
+            return self
+
+        gamma_bar = gamma_hat.mean(axis=1)[:, np.newaxis]
+        tau2 = gamma_hat.var(axis=1, ddof=1)[:, np.newaxis]
+        delta_mean = delta_hat.mean(axis=1)[:, np.newaxis]
+        delta_var = np.maximum(
+            delta_hat.var(axis=1, ddof=1)[:, np.newaxis], eps)
+        a_prior = (2 * delta_var + delta_mean ** 2) / delta_var
+        b_prior = (delta_mean * delta_var + delta_mean ** 3) / delta_var
+
+        # empirical Bayes estimates for all the sites and features at once
+        gamma, delta = gamma_hat, delta_hat
+        for self.n_iter_ in range(1, self.max_iter + 1):
+            gamma_new = ((n_subjects_site * tau2 * gamma_hat +
+                          delta * gamma_bar) /
+                         (n_subjects_site * tau2 + delta))
+            sum_squares = (sum_z2 - 2 * gamma_new * sum_z +
+                           n_subjects_site * gamma_new ** 2)
+            delta_new = ((b_prior + 0.5 * sum_squares) /
+                         (n_subjects_site / 2 + a_prior - 1))
+            change = max(
+                np.max(np.abs(gamma_new - gamma) / (np.abs(gamma) + eps)),
+                np.max(np.abs(delta_new - delta) / delta))
+            gamma, delta = gamma_new, delta_new
+            if change < self.tol:
+                break
+        self.gamma_, self.delta_ = gamma, delta
+        return self
+
+    def transform(self, X, sites):
+        X = np.array(X, dtype=np.float64)
+        sites = np.asarray(sites)
+        if self.sites_.size == 0:
+            return X
+        site_idx = np.searchsorted(self.sites_, sites)
+        site_idx[site_idx == self.sites_.size] = 0
+        known = self.sites_[site_idx] == sites
+        site_idx = site_idx[known]
+
+        Z = (X[known] - self.mean_) / self.scale_
+        Z = (Z - self.gamma_[site_idx]) / np.sqrt(self.delta_[site_idx])
+        X[known] = Z * self.scale_ + self.mean_
+        return X
+
+    def fit_transform(self, X, sites):
+        # the sites are needed by transform, unlike what TransformerMixin
+        # expects from the second argument
+        return self.fit(X, sites).transform(X, sites)
+
+
+def _get_anatomy(X_df):
+    X_anatomy = X_df[[col for col in X_df.columns
+                      if col.startswith('anatomy')]]
+    return X_anatomy.drop(columns='anatomy_select')
+
+
+class FeatureExtractor(BaseEstimator, TransformerMixin):
+    def __init__(self):
+        # make a transformer which will load the time series and compute the
+        # connectome matrix
+        self.transformer_fmri = make_pipeline(
+            FunctionTransformer(func=_load_fmri, validate=False),
+            ConnectivityMeasure(kind='tangent', vectorize=True))
+        # the site effects are removed separately for each modality since
+        # the empirical Bayes priors are shared across features
+        self.combat_connectome = ComBat()
+        self.combat_anatomy = ComBat()
+
+    def fit(self, X_df, y):
+        fmri_filenames = X_df['fmri_msdl']
+        sites = X_df['participants_site']
+        _with_store(self.transformer_fmri).fit(fmri_filenames, y)
+        X_connectome = _with_store(self.transformer_fmri).transform(
+            fmri_filenames)
+        self.combat_connectome.fit(X_connectome, sites)
+        self.combat_anatomy.fit(_get_anatomy(X_df), sites)
+        return self
+
+    def transform(self, X_df):
+        fmri_filenames = X_df['fmri_msdl']
+        sites = X_df['participants_site']
+        X_connectome = _with_store(self.transformer_fmri).transform(
+            fmri_filenames)
+        X_connectome = pd.DataFrame(
+            self.combat_connectome.transform(X_connectome, sites),
+            index=X_df.index)
+        X_connectome.columns = ['connectome_{}'.format(i)
+                                for i in range(X_connectome.columns.size)]
+        # get the anatomical information
+        X_anatomy = _get_anatomy(X_df)
+        X_anatomy = pd.DataFrame(
+            self.combat_anatomy.transform(X_anatomy, sites),
+            index=X_anatomy.index, columns=X_anatomy.columns)
+        # concatenate both matrices
+        return pd.concat([X_connectome, X_anatomy], axis=1)
@@ -0,0 +1,89 @@
+import numpy as np
+
+from sklearn.base import BaseEstimator, clone
+from sklearn.preprocessing import StandardScaler
+from sklearn.linear_model import SGDClassifier
+from sklearn.model_selection import train_test_split
+
+
+def _get_rows(X, idx):
+    """Load in memory the rows of an array, a memory map or a dataframe."""
+    if hasattr(X, 'iloc'):
+        return X.iloc[idx].values
+    return np.asarray(X[idx])
+
+
+class Classifier(BaseEstimator):
+    """Logistic regression fitted by mini-batches of subjects.
+
+    The features are only loaded in memory by mini-batches, both to fit the
+    scaler and to fit the logistic regression with stochastic gradient
+    descent. The training stops when the log-loss on a validation set did
+    not improve for `n_iter_no_change` epochs.
+    """
+
+    def __init__(self):
+        self.scaler = StandardScaler()
+        self.clf = SGDClassifier(loss='log', alpha=1e-3, random_state=42)
+        self.batch_size = 64
+        self.max_epochs = 100
+        self.n_iter_no_change = 5
+        self.validation_fraction = 0.1
+        self.tol = 1e-4
+
+    def _batches(self, idx):
+        n_batches = max(1, int(np.ceil(idx.size / self.batch_size)))
+        # sorted rows are read sequentially from a memory map
+        return [np.sort(batch) for batch in np.array_split(idx, n_batches)]
+
+    def _predict_proba(self, X, idx):
+        return np.concatenate([
+            self.clf.predict_proba(self.scaler.transform(_get_rows(X, batch)))
+            for batch in self._batches(idx)])
+
+    def fit(self, X, y):
+        # partial_fit accumulates over the calls to fit otherwise
+        self.scaler = clone(self.scaler)
+        self.clf = clone(self.clf)
+        train_idx, validation_idx = train_test_split(
+            np.arange(y.size), test_size=self.validation_fraction,
+            shuffle=True, stratify=y, random_state=42)
+        validation_idx = np.sort(validation_idx)
+        for batch in self._batches(train_idx):
+            self.scaler.partial_fit(_get_rows(X, batch))
+
+        classes = np.unique(y)
+        y_validation = np.searchsorted(classes, y[validation_idx])
+        rng = np.random.RandomState(42)
+        best_loss, n_epochs_no_change = np.inf, 0
+        best_coef = None
+        for epoch in range(self.max_epochs):
+            rng.shuffle(train_idx)
+            for batch in self._batches(train_idx):
+                self.clf.partial_fit(
+                    self.scaler.transform(_get_rows(X, batch)), y[batch],
+                    classes=classes)
+            y_pred = self._predict_proba(X, validation_idx)
+            loss = -np.mean(np.log(np.clip(
+                y_pred[np.arange(y_validation.size), y_validation],
+                1e-15, None)))
+            if loss < best_loss - self.tol:
+                best_loss, n_epochs_no_change = loss, 0
+                best_coef = (self.clf.coef_.copy(),
+                             self.clf.intercept_.copy())
+            else:
+                n_epochs_no_change += 1
+                if n_epochs_no_change >= self.n_iter_no_change:
+                    break
+        # keep the coefficients with the lowest validation loss, if any loss
+        # was finite
+        if best_coef is not None:
+            self.clf.coef_, self.clf.intercept_ = best_coef
+        return self
+
+    def predict(self, X):
+        y_pred = self.predict_proba(X)
+        return self.clf.classes_[np.argmax(y_pred, axis=1)]
+
+    def predict_proba(self, X):
+        return self._predict_proba(X, np.arange(X.shape[0]))
@@ -0,0 +1,301 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from sklearn.base import BaseEstimator, TransformerMixin
+
+from nilearn.connectome import ConnectivityMeasure, GroupSparseCovariance
+
+# atlases whose connectomes are concatenated with the anatomical features
+ATLASES = ('msdl', 'basc064')
+
+
+def _load_fmri(fmri_filenames):
+    """Load time-series extracted from the fMRI using a specific atlas."""
+    return np.array([pd.read_csv(subject_filename,
+                                 header=None).values
+                     for subject_filename in fmri_filenames])
+
+
+def _open_memmap(shape):
+    """Create a float32 array stored in a temporary file.
+
+    The file is created in the directory given by the environment variable
+    `AUTISM_MEMMAP_DIR` or, by default, in the temporary directory, which
+    may be kept in memory.
+    """
+    fd, filename = tempfile.mkstemp(suffix='.npy',
+                                    dir=os.environ.get('AUTISM_MEMMAP_DIR'))
+    os.close(fd)
+    X = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32,
+                                  shape=shape)
+    try:
+        # the memory map keeps the data available once the file is removed
+        os.remove(filename)
+    except OSError:
+        pass
+    return X
+
+
+def _reference_subjects(fmri_filenames, max_reference_memory=None):
+    """Select the subjects used to fit the reference of the tangent space.
+
+    All the subjects are selected, unless keeping their covariances in
+    memory as float64 would take more than `max_reference_memory` megabytes:
+    a random subset of subjects is then selected.
+    """
+    n_subjects = fmri_filenames.size
+    if max_reference_memory is None:
+        return np.arange(n_subjects)
+    n_regions = pd.read_csv(fmri_filenames.iloc[0], header=None,
+                            nrows=1).shape[1]
+    n_reference = max(2, int(max_reference_memory * 1e6 //
+                             (8 * n_regions ** 2)))
+    if n_reference >= n_subjects:
+        return np.arange(n_subjects)
+    return np.sort(np.random.RandomState(42).permutation(
+        n_subjects)[:n_reference])
+
+
+def _shrunk_covariances(time_series, estimator='ledoit_wolf'):
+    """Compute the shrunk covariances of time series of the same length.
+
+    Parameters
+    ----------
+    time_series : ndarray, shape (n_subjects, n_samples, n_regions)
+        The time series of the subjects.
+
+    estimator : {'ledoit_wolf', 'oas'}, default='ledoit_wolf'
+        The formula used to compute the shrinkage of each subject.
+
+    Returns
+    -------
+    covariances : ndarray, shape (n_subjects, n_regions, n_regions)
+        The shrunk covariances.
+
+    """
+    n_samples, n_regions = time_series.shape[1:]
+    time_series = time_series - time_series.mean(axis=1, keepdims=True)
+    emp_covs = np.matmul(time_series.transpose(0, 2, 1),
+                         time_series) / n_samples
+    mu = np.trace(emp_covs, axis1=1, axis2=2) / n_regions
+    if estimator == 'ledoit_wolf':
+        # the sum of the products of squared signals only depends on the
+        # squared norm of each sample
+        beta = np.sum(np.sum(time_series ** 2, axis=2) ** 2, axis=1)
+        delta = np.sum(emp_covs ** 2, axis=(1, 2))
+        beta = (beta / n_samples - delta) / (n_regions * n_samples)
+        delta = (delta - n_regions * mu ** 2) / n_regions
+        beta = np.minimum(beta, delta)
+        shrinkage = np.where(beta == 0, 0., beta / np.where(delta == 0, 1.,
+                                                            delta))
+    else:
+        alpha = np.mean(emp_covs ** 2, axis=(1, 2))
+        num = alpha + mu ** 2
+        den = (n_samples + 1.) * (alpha - mu ** 2 / n_regions)
+        shrinkage = np.where(den == 0, 1., np.minimum(
+            num / np.where(den == 0, 1., den), 1.))
+    shrinkage = shrinkage[:, np.newaxis, np.newaxis]
+    return ((1. - shrinkage) * emp_covs +
+            shrinkage * mu[:, np.newaxis, np.newaxis] * np.eye(n_regions))
+
+
+def _sparse_precision_covariances(covariances, support, max_iter=100,
+                                  tol=1e-4):
+    """Estimate covariances whose inverse is zero outside of a support.
+
+    The covariances of all the subjects are updated at once, column by
+    column, as in the algorithm 17.1 of [1]_: each covariance keeps its
+    values on the support and its inverse is zero elsewhere.
+
+    Parameters
+    ----------
+    covariances : ndarray, shape (n_subjects, n_regions, n_regions)
+        The covariances of the subjects.
+
+    support : ndarray of bool, shape (n_regions, n_regions)
+        The non-zero entries of the precisions.
+
+    Returns
+    -------
+    covariances : ndarray, shape (n_subjects, n_regions, n_regions)
+        The covariances with a sparse inverse.
+
+    References
+    ----------
+    .. [1] Hastie, Trevor, et al. "The elements of statistical learning."
+       Springer, 2nd edition (2009).
+
+    """
+    n_regions = covariances.shape[1]
+    estimates = covariances.copy()
+    for _ in range(max_iter):
+        change = 0.
+        for region in range(n_regions):
+            others = np.delete(np.arange(n_regions), region)
+            neighbors = others[support[region, others]]
+            if neighbors.size:
+                coefs = np.linalg.solve(
+                    estimates[:, neighbors][:, :, neighbors],
+                    covariances[:, neighbors, region][..., np.newaxis])
+                column = np.matmul(estimates[:, others][:, :, neighbors],
+                                   coefs)[..., 0]
+            else:
+                column = np.zeros((estimates.shape[0], others.size))
+            change = max(change,
+                         np.max(np.abs(column - estimates[:, others, region])))
+            estimates[:, others, region] = column
+            estimates[:, region, others] = column
+        if change < tol * np.max(np.abs(covariances)):
+            break
+    return estimates
+
+
+class ShrunkCovariances(BaseEstimator, TransformerMixin):
+    """Estimate the covariance of the time series of all the subjects.
+
+    Parameters
+    ----------
+    estimator : {'ledoit_wolf', 'oas', 'group_sparse'}, default='ledoit_wolf'
+        With `'ledoit_wolf'` and `'oas'`, each empirical covariance is shrunk
+        towards a scaled identity; the subjects with the same number of
+        samples are stacked and estimated together. With `'group_sparse'`,
+        the sparsity pattern shared by the precisions of the training
+        subjects is estimated in `fit` [1]_. The Ledoit-Wolf covariance of
+        each subject is then estimated under this pattern, its inverse being
+        zero outside of it: the sparse precisions are given by
+        `ConnectivityMeasure(kind='precision')`.
+
+    alpha : float, default=0.1
+        The regularization of the `'group_sparse'` estimator.
+
+    References
+    ----------
+    .. [1] Varoquaux, Gael, et al. "Brain covariance selection: better
+       individual functional connectivity models using population prior."
+       Advances in Neural Information Processing Systems. 2010.
+
+    """
+
+    def __init__(self, estimator='ledoit_wolf', alpha=0.1):
+        self.estimator = estimator
+        self.alpha = alpha
+
+    def fit(self, X, y=None):
+        if self.estimator == 'group_sparse':
+            # the pattern is only learnt from the training subjects and each
+            # subject is then estimated on its own
+            precisions = GroupSparseCovariance(alpha=self.alpha).fit(
+                list(X)).precisions_
+            self.support_ = np.any(precisions != 0, axis=2)
+        return self
+
+    def transform(self, X):
+        if self.estimator not in ('ledoit_wolf', 'oas', 'group_sparse'):
+            raise ValueError("'estimator' should be one of 'ledoit_wolf', "
+                             "'oas' or 'group_sparse'. Got {} instead."
+                             .format(self.estimator))
+        estimator = self.estimator
+        if estimator == 'group_sparse':
+            estimator = 'ledoit_wolf'
+        covariances = [None] * len(X)
+        n_samples = np.array([time_series.shape[0] for time_series in X])
+        for n_samples_batch in np.unique(n_samples):
+            subject_idx = np.flatnonzero(n_samples == n_samples_batch)
+            batch_covariances = _shrunk_covariances(
+                np.stack([X[idx] for idx in subject_idx]), estimator)
+            for idx, covariance in zip(subject_idx, batch_covariances):
+                covariances[idx] = covariance
+        if self.estimator == 'group_sparse':
+            covariances = list(_sparse_precision_covariances(
+                np.array(covariances), self.support_))
+        return covariances
+
+
+class _PrecomputedCovariance(BaseEstimator):
+    """Covariance estimator for inputs which already are covariances."""
+
+    def fit(self, X, y=None):
+        try:
+            np.linalg.cholesky(X)
+        except np.linalg.LinAlgError:
+            # the standardization of the covariances done by
+            # ConnectivityMeasure(kind='correlation') makes them singular
+            raise ValueError("The precomputed covariance is not positive "
+                             "definite. Note that it cannot be used with "
+                             "ConnectivityMeasure(kind='correlation'): use "
+                             "kind='covariance' and convert the covariances "
+                             "to correlations instead.")
+        self.covariance_ = X
+        return self
+
+
+def _get_anatomy(X_df):
+    X_anatomy = X_df[[col for col in X_df.columns
+                      if col.startswith('anatomy')]]
+    return X_anatomy.drop(columns='anatomy_select')
+
+
+class FeatureExtractor(BaseEstimator, TransformerMixin):
+    """Connectomes of several atlases written on disk.
+
+    Parameters
+    ----------
+    max_reference_memory : float, default=None
+        The memory in megabytes of the covariances used to fit the reference
+        of the tangent space of each atlas. By default, the covariances of all
+        the training subjects are used. Otherwise, a random subset of
+        subjects is used if needed.
+
+    """
+
+    def __init__(self, max_reference_memory=None):
+        self.max_reference_memory = max_reference_memory
+        self.covariance = ShrunkCovariances(estimator='ledoit_wolf')
+        self.connectivities = [
+            ConnectivityMeasure(cov_estimator=_PrecomputedCovariance(),
+                                kind='tangent', vectorize=True)
+            for _ in ATLASES]
+        self.batch_size = 64
+
+    def _batches(self, n_subjects):
+        n_batches = max(1, int(np.ceil(n_subjects / self.batch_size)))
+        return np.array_split(np.arange(n_subjects), n_batches)
+
+    def _covariances(self, fmri_filenames, batch):
+        return self.covariance.transform(
+            _load_fmri(fmri_filenames.iloc[batch]))
+
+    def fit(self, X_df, y):
+        for atlas, connectivity in zip(ATLASES, self.connectivities):
+            fmri_filenames = X_df['fmri_{}'.format(atlas)]
+            fmri_filenames = fmri_filenames.iloc[_reference_subjects(
+                fmri_filenames, self.max_reference_memory)]
+            covariances = []
+            for batch in self._batches(fmri_filenames.size):
+                covariances.extend(self._covariances(fmri_filenames, batch))
+            connectivity.fit(covariances)
+        return self
+
+    def transform(self, X_df):
+        X_anatomy = _get_anatomy(X_df)
+        n_edges = [connectivity.mean_.shape[0] *
+                   (connectivity.mean_.shape[0] + 1) // 2
+                   for connectivity in self.connectivities]
+        # the features are written on disk by mini-batches of subjects and
+        # the classifier reads them the same way
+        X = _open_memmap((X_df.shape[0], sum(n_edges) + X_anatomy.shape[1]))
+        for batch in self._batches(X_df.shape[0]):
+            start = 0
+            for atlas, connectivity, n_edges_atlas in zip(
+                    ATLASES, self.connectivities, n_edges):
+                fmri_filenames = X_df['fmri_{}'.format(atlas)]
+                X[batch, start:start + n_edges_atlas] = \
+                    connectivity.transform(
+                        self._covariances(fmri_filenames, batch))
+                start += n_edges_atlas
+        X[:, start:] = X_anatomy.values
+        X.flush()
+        return X
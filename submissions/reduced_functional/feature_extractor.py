@@ -0,0 +1,352 @@
+import numpy as np
+import pandas as pd
+
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.decomposition import IncrementalPCA
+
+from nilearn.connectome import ConnectivityMeasure, GroupSparseCovariance
+
+
+def _load_fmri(fmri_filenames):
+    """Load time-series extracted from the fMRI using a specific atlas."""
+    return np.array([pd.read_csv(subject_filename,
+                                 header=None).values
+                     for subject_filename in fmri_filenames])
+
+
+def _shrunk_covariances(time_series, estimator='ledoit_wolf'):
+    """Compute the shrunk covariances of time series of the same length.
+
+    Parameters
+    ----------
+    time_series : ndarray, shape (n_subjects, n_samples, n_regions)
+        The time series of the subjects.
+
+    estimator : {'ledoit_wolf', 'oas'}, default='ledoit_wolf'
+        The formula used to compute the shrinkage of each subject.
+
+    Returns
+    -------
+    covariances : ndarray, shape (n_subjects, n_regions, n_regions)
+        The shrunk covariances.
+
+    """
+    n_samples, n_regions = time_series.shape[1:]
+    time_series = time_series - time_series.mean(axis=1, keepdims=True)
+    emp_covs = np.matmul(time_series.transpose(0, 2, 1),
+                         time_series) / n_samples
+    mu = np.trace(emp_covs, axis1=1, axis2=2) / n_regions
+    if estimator == 'ledoit_wolf':
+        # the sum of the products of squared signals only depends on the
+        # squared norm of each sample
+        beta = np.sum(np.sum(time_series ** 2, axis=2) ** 2, axis=1)
+        delta = np.sum(emp_covs ** 2, axis=(1, 2))
+        beta = (beta / n_samples - delta) / (n_regions * n_samples)
+        delta = (delta - n_regions * mu ** 2) / n_regions
+        beta = np.minimum(beta, delta)
+        shrinkage = np.where(beta == 0, 0., beta / np.where(delta == 0, 1.,
+                                                            delta))
+    else:
+        alpha = np.mean(emp_covs ** 2, axis=(1, 2))
+        num = alpha + mu ** 2
+        den = (n_samples + 1.) * (alpha - mu ** 2 / n_regions)
+        shrinkage = np.where(den == 0, 1., np.minimum(
+            num / np.where(den == 0, 1., den), 1.))
+    shrinkage = shrinkage[:, np.newaxis, np.newaxis]
+    return ((1. - shrinkage) * emp_covs +
+            shrinkage * mu[:, np.newaxis, np.newaxis] * np.eye(n_regions))
+
+
+def _sparse_precision_covariances(covariances, support, max_iter=100,
+                                  tol=1e-4):
+    """Estimate covariances whose inverse is zero outside of a support.
+
+    The covariances of all the subjects are updated at once, column by
+    column, as in the algorithm 17.1 of [1]_: each covariance keeps its
+    values on the support and its inverse is zero elsewhere.
+
+    Parameters
+    ----------
+    covariances : ndarray, shape (n_subjects, n_regions, n_regions)
+        The covariances of the subjects.
+
+    support : ndarray of bool, shape (n_regions, n_regions)
+        The non-zero entries of the precisions.
+
+    Returns
+    -------
+    covariances : ndarray, shape (n_subjects, n_regions, n_regions)
+        The covariances with a sparse inverse.
+
+    References
+    ----------
+    .. [1] Hastie, Trevor, et al. "The elements of statistical learning."
+       Springer, 2nd edition (2009).
+
+    """
+    n_regions = covariances.shape[1]
+    estimates = covariances.copy()
+    for _ in range(max_iter):
+        change = 0.
+        for region in range(n_regions):
+            others = np.delete(np.arange(n_regions), region)
+            neighbors = others[support[region, others]]
+            if neighbors.size:
+                coefs = np.linalg.solve(
+                    estimates[:, neighbors][:, :, neighbors],
+                    covariances[:, neighbors, region][..., np.newaxis])
+                column = np.matmul(estimates[:, others][:, :, neighbors],
+                                   coefs)[..., 0]
+            else:
+                column = np.zeros((estimates.shape[0], others.size))
+            change = max(change,
+                         np.max(np.abs(column - estimates[:, others, region])))
+            estimates[:, others, region] = column
+            estimates[:, region, others] = column
+        if change < tol * np.max(np.abs(covariances)):
+            break
+    return estimates
+
+
+class ShrunkCovariances(BaseEstimator, TransformerMixin):
+    """Estimate the covariance of the time series of all the subjects.
+
+    Parameters
+    ----------
+    estimator : {'ledoit_wolf', 'oas', 'group_sparse'}, default='ledoit_wolf'
+        With `'ledoit_wolf'` and `'oas'`, each empirical covariance is shrunk
+        towards a scaled identity; the subjects with the same number of
+        samples are stacked and estimated together. With `'group_sparse'`,
+        the sparsity pattern shared by the precisions of the training
+        subjects is estimated in `fit` [1]_. The Ledoit-Wolf covariance of
+        each subject is then estimated under this pattern, its inverse being
+        zero outside of it: the sparse precisions are given by
+        `ConnectivityMeasure(kind='precision')`.
+
+    alpha : float, default=0.1
+        The regularization of the `'group_sparse'` estimator.
+
+    References
+    ----------
+    .. [1] Varoquaux, Gael, et al. "Brain covariance selection: better
+       individual functional connectivity models using population prior."
+       Advances in Neural Information Processing Systems. 2010.
+
+    """
+
+    def __init__(self, estimator='ledoit_wolf', alpha=0.1):
+        self.estimator = estimator
+        self.alpha = alpha
+
+    def fit(self, X, y=None):
+        if self.estimator == 'group_sparse':
+            # the pattern is only learnt from the training subjects and each
+            # subject is then estimated on its own
+            precisions = GroupSparseCovariance(alpha=self.alpha).fit(
+                list(X)).precisions_
+            self.support_ = np.any(precisions != 0, axis=2)
+        return self
+
+    def transform(self, X):
+        if self.estimator not in ('ledoit_wolf', 'oas', 'group_sparse'):
+            raise ValueError("'estimator' should be one of 'ledoit_wolf', "
+                             "'oas' or 'group_sparse'. Got {} instead."
+                             .format(self.estimator))
+        estimator = self.estimator
+        if estimator == 'group_sparse':
+            estimator = 'ledoit_wolf'
+        covariances = [None] * len(X)
+        n_samples = np.array([time_series.shape[0] for time_series in X])
+        for n_samples_batch in np.unique(n_samples):
+            subject_idx = np.flatnonzero(n_samples == n_samples_batch)
+            batch_covariances = _shrunk_covariances(
+                np.stack([X[idx] for idx in subject_idx]), estimator)
+            for idx, covariance in zip(subject_idx, batch_covariances):
+                covariances[idx] = covariance
+        if self.estimator == 'group_sparse':
+            covariances = list(_sparse_precision_covariances(
+                np.array(covariances), self.support_))
+        return covariances
+
+
+class _PrecomputedCovariance(BaseEstimator):
+    """Covariance estimator for inputs which already are covariances."""
+
+    def fit(self, X, y=None):
+        try:
+            np.linalg.cholesky(X)
+        except np.linalg.LinAlgError:
+            # the standardization of the covariances done by
+            # ConnectivityMeasure(kind='correlation') makes them singular
+            raise ValueError("The precomputed covariance is not positive "
+                             "definite. Note that it cannot be used with "
+                             "ConnectivityMeasure(kind='correlation'): use "
+                             "kind='covariance' and convert the covariances "
+                             "to correlations instead.")
+        self.covariance_ = X
+        return self
+
+
+def _reference_subjects(fmri_filenames, max_reference_memory=None):
+    """Select the subjects used to fit the reference of the tangent space.
+
+    All the subjects are selected, unless keeping their covariances in
+    memory as float64 would take more than `max_reference_memory` megabytes:
+    a random subset of subjects is then selected.
+    """
+    n_subjects = fmri_filenames.size
+    if max_reference_memory is None:
+        return np.arange(n_subjects)
+    n_regions = pd.read_csv(fmri_filenames.iloc[0], header=None,
+                            nrows=1).shape[1]
+    n_reference = max(2, int(max_reference_memory * 1e6 //
+                             (8 * n_regions ** 2)))
+    if n_reference >= n_subjects:
+        return np.arange(n_subjects)
+    return np.sort(np.random.RandomState(42).permutation(
+        n_subjects)[:n_reference])
+
+
+class EdgeScreening(BaseEstimator, TransformerMixin):
+    """Keep the edges with the largest ANOVA F-value.
+
+    The F-values are computed from the number of subjects, the sum and the
+    sum of squares of each edge in each class, which are accumulated over
+    mini-batches of subjects with `partial_fit`.
+
+    Parameters
+    ----------
+    n_edges : int, default=1000
+        The number of edges kept.
+
+    """
+
+    def __init__(self, n_edges=1000):
+        self.n_edges = n_edges
+
+    def partial_fit(self, X, y):
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y)
+        if not hasattr(self, 'classes_'):
+            self.classes_ = np.array([], dtype=y.dtype)
+            self.n_samples_ = np.zeros(0)
+            self.sums_ = np.zeros((0, X.shape[1]))
+            self.sums_squares_ = np.zeros((0, X.shape[1]))
+        new_classes = np.setdiff1d(np.unique(y), self.classes_)
+        if new_classes.size:
+            self.classes_ = np.concatenate([self.classes_, new_classes])
+            self.n_samples_ = np.concatenate(
+                [self.n_samples_, np.zeros(new_classes.size)])
+            zeros = np.zeros((new_classes.size, X.shape[1]))
+            self.sums_ = np.concatenate([self.sums_, zeros])
+            self.sums_squares_ = np.concatenate([self.sums_squares_, zeros])
+        # one-hot encoding of the classes, shape (n_classes, n_samples)
+        design = (y == self.classes_[:, np.newaxis]).astype(np.float64)
+        self.n_samples_ += design.sum(axis=1)
+        self.sums_ += design.dot(X)
+        self.sums_squares_ += design.dot(X ** 2)
+
+        # one-way ANOVA as in sklearn.feature_selection.f_classif
+        n_samples = self.n_samples_[:, np.newaxis]
+        n_samples_total = self.n_samples_.sum()
+        sum_squares_between = (np.sum(self.sums_ ** 2 /
+                                      np.maximum(n_samples, 1), axis=0) -
+                               self.sums_.sum(axis=0) ** 2 / n_samples_total)
+        sum_squares_within = (self.sums_squares_.sum(axis=0) -
+                              np.sum(self.sums_ ** 2 /
+                                     np.maximum(n_samples, 1), axis=0))
+        dof_between = np.sum(self.n_samples_ > 0) - 1
+        dof_within = n_samples_total - dof_between - 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.scores_ = ((sum_squares_between / max(dof_between, 1)) /
+                            (sum_squares_within / max(dof_within, 1)))
+        self.scores_[~np.isfinite(self.scores_)] = 0.
+        self.support_ = np.sort(np.argsort(-self.scores_)[:self.n_edges])
+        return self
+
+    def fit(self, X, y):
+        for attribute in ('classes_', 'n_samples_', 'sums_',
+                          'sums_squares_'):
+            if hasattr(self, attribute):
+                delattr(self, attribute)
+        return self.partial_fit(X, y)
+
+    def transform(self, X):
+        return np.asarray(X)[:, self.support_]
+
+
+class FeatureExtractor(BaseEstimator, TransformerMixin):
+    """Connectomes reduced by mini-batches of subjects.
+
+    Parameters
+    ----------
+    reduction : {'pca', 'screening'}, default='pca'
+        The reduction of the connectomes, fitted by mini-batches of subjects
+        without storing the connectomes of all the subjects: an incremental
+        PCA keeping 100 components or the screening of the 1000 edges with
+        the largest ANOVA F-value.
+
+    max_reference_memory : float, default=None
+        The memory in megabytes of the covariances used to fit the reference
+        of the tangent space. By default, the covariances of all the training
+        subjects are used. Otherwise, a random subset of subjects is used if
+        needed and the time series are loaded again by batches to fit the
+        reduction.
+
+    """
+
+    def __init__(self, reduction='pca', max_reference_memory=None):
+        self.reduction = reduction
+        self.max_reference_memory = max_reference_memory
+        self.covariance = ShrunkCovariances(estimator='ledoit_wolf')
+        self.connectivity = ConnectivityMeasure(
+            cov_estimator=_PrecomputedCovariance(), kind='tangent',
+            vectorize=True)
+        self.batch_size = 200
+
+    def _batches(self, n_subjects):
+        # balanced batches such that none is much smaller than the others
+        n_batches = max(1, int(np.ceil(n_subjects / self.batch_size)))
+        return np.array_split(np.arange(n_subjects), n_batches)
+
+    def _covariances(self, fmri_filenames):
+        """Yield the subjects and the covariances of each batch."""
+        for batch in self._batches(fmri_filenames.size):
+            yield batch, self.covariance.transform(
+                _load_fmri(fmri_filenames.iloc[batch]))
+
+    def fit(self, X_df, y):
+        if self.reduction == 'pca':
+            self.reduction_ = IncrementalPCA(n_components=100)
+        elif self.reduction == 'screening':
+            self.reduction_ = EdgeScreening(n_edges=1000)
+        else:
+            raise ValueError("'reduction' should be 'pca' or 'screening'. "
+                             "Got {} instead.".format(self.reduction))
+        # get only the time series for the MSDL atlas
+        fmri_filenames = X_df['fmri_msdl']
+        reference_idx = _reference_subjects(fmri_filenames,
+                                            self.max_reference_memory)
+        reference_covariances = [
+            covariance for _, covariances in self._covariances(
+                fmri_filenames.iloc[reference_idx])
+            for covariance in covariances]
+        self.connectivity.fit(reference_covariances)
+        if reference_idx.size == fmri_filenames.size:
+            batches = [(batch, [reference_covariances[idx] for idx in batch])
+                       for batch in self._batches(fmri_filenames.size)]
+        else:
+            # the time series are loaded again by batches
+            del reference_covariances
+            batches = self._covariances(fmri_filenames)
+        for batch, covariances in batches:
+            self.reduction_.partial_fit(
+                self.connectivity.transform(covariances), y[batch])
+        return self
+
+    def transform(self, X_df):
+        fmri_filenames = X_df['fmri_msdl']
+        return np.concatenate([
+            self.reduction_.transform(
+                self.connectivity.transform(covariances))
+            for _, covariances in self._covariances(fmri_filenames)])